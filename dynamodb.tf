@@ -0,0 +1,15 @@
+resource "aws_dynamodb_table" "bedrock_response_cache" {
+  name         = "troubleshoot-terraform-bedrock-cache"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "cache_key"
+
+  attribute {
+    name = "cache_key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
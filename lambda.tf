@@ -43,9 +43,17 @@ resource "aws_iam_role_policy" "lambda_logging" {
         "logs:CreateLogStream",
         "logs:PutLogEvents",
         "bedrock:InvokeModel",
+        "bedrock:InvokeModelWithResponseStream",
       ]
       Effect   = "Allow"
       Resource = "*"
+      }, {
+      Action = [
+        "dynamodb:GetItem",
+        "dynamodb:PutItem",
+      ]
+      Effect   = "Allow"
+      Resource = aws_dynamodb_table.bedrock_response_cache.arn
     }]
   })
 }
@@ -57,14 +65,15 @@ resource "aws_lambda_function" "my_lambda_function" {
   role             = aws_iam_role.lambda_exec_role.arn
   filename         = data.archive_file.lambda_zip_archive.output_path
   source_code_hash = data.archive_file.lambda_zip_archive.output_base64sha256
-  timeout          = 60
+  timeout          = 300
   memory_size      = 512
 
   layers = [aws_lambda_layer_version.lambda_layer_version.arn]
 
   environment {
     variables = {
-      GITHUB_PAT = var.github_pat
+      GITHUB_PAT          = var.github_pat
+      BEDROCK_CACHE_TABLE = aws_dynamodb_table.bedrock_response_cache.name
     }
   }
 }
\ No newline at end of file
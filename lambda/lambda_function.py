@@ -1,14 +1,41 @@
+import hashlib
+import itertools
 import json
 import logging
 import os
+import re
+import time
 import boto3
+import orjson
 import requests
 import base64
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-bedrock = boto3.client(service_name='bedrock-runtime')
+# Keep connections alive across warm invocations and back off adaptively when throttled
+aws_client_config = Config(
+    tcp_keepalive=True,
+    max_pool_connections=16,
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    connect_timeout=3,
+    read_timeout=60
+)
+
+bedrock = boto3.client(service_name='bedrock-runtime', config=aws_client_config)
+dynamodb = boto3.client(service_name='dynamodb', config=aws_client_config)
+
+# Fixes that were opened as pull requests are recorded in this table when it is set, so re-runs of the
+# same failure report the open fix instead of proposing another one. Unset it to disable the cache
+BEDROCK_CACHE_TABLE = os.environ.get("BEDROCK_CACHE_TABLE")
+BEDROCK_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# /tmp persists across warm invocations of the same Lambda container
+ETAG_CACHE_PATH = "/tmp/etag_cache.json"
 
 GITHUB_HEADERS = {
     'Accept': 'application/vnd.github+json',
@@ -16,136 +43,264 @@ GITHUB_HEADERS = {
     'User-Agent': 'lambda_function'
 }
 
+# Shared across warm invocations so connections to GitHub are pooled
+session = requests.Session()
+session.headers.update(GITHUB_HEADERS)
+session.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    # Only transient server errors are retried, a rate limit is reported instead of hammered.
+    # Retry-After can outlast the Lambda timeout, and the final response is returned so callers
+    # still get an HTTPError from raise_for_status
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[500, 502, 503, 504],
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+))
+
+REQUIRED_EVENT_FIELDS = ('repo_name', 'branch_name', 'logs_url')
+
+TERRAFORM_EXTENSIONS = ('.tf', '.tfvars')
+TERRAFORM_FILE_PATTERN = re.compile(r'([A-Za-z0-9_./-]+\.tf(?:vars)?)\b')
+
+# Fixes often land in these files rather than the one the error points at, so they are always sent
+SHARED_TERRAFORM_FILES = ('variables.tf', 'outputs.tf')
+
+# Matched against the raw log bytes, so non-matching lines are never decoded or lowercased
+ERROR_PATTERN = re.compile(rb'error', re.IGNORECASE)
+
+# GitHub prefixes every log line with a timestamp and Terraform colours its output, both are
+# stripped so re-runs of the same failure produce the same error text
+LOG_NOISE_PATTERN = re.compile(rb'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:\.\d+)?Z ?|\x1b\[[0-9;]*m')
+
+# Lines kept from the first error onwards, reading stops once this many are collected
+MAX_ERROR_CONTEXT_LINES = 200
+
+RESPONSE_SECTIONS_PATTERN = re.compile(r"\[TROUBLESHOOTING\](.*?)\[REMEDIATION_JSON\](.*)", re.DOTALL)
+
+REMEDIATION_FIELDS = ('branch_name', 'commit_message', 'pr_title', 'pr_body', 'files')
+
+JSON_FENCE_PATTERN = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+
+# Nova supports prompt caching through the Converse API
+MODEL_ID = "amazon.nova-pro-v1:0"
+
+SYSTEM_PROMPT = "You are an expert in troubleshooting and fixing Terraform code issues."
+
+INFERENCE_CONFIG = {
+    "temperature": 0.7,
+    "topP": 0.9,
+    # Nova Pro's output limit, the full content of every changed file has to fit in one response
+    "maxTokens": 10000
+}
+
+REPO_FILES_QUERY = """
+query($owner: String!, $name: String!, $expression: String!) {
+  repository(owner: $owner, name: $name) {
+    object(expression: $expression) {
+      ... on Tree {
+        entries {
+          name
+          type
+          object {
+            ... on Blob {
+              text
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+CREATE_COMMIT_MUTATION = """
+mutation($input: CreateCommitOnBranchInput!) {
+  createCommitOnBranch(input: $input) {
+    commit {
+      url
+    }
+  }
+}
+"""
+
 def lambda_handler(event, context):
     logger.info("Received event: %s", json.dumps(event))
 
+    # Validate the event up front so a missing field is reported before any request is made
+    missing_fields = [field for field in REQUIRED_EVENT_FIELDS if not event.get(field)]
+    if missing_fields:
+        logger.error(f"Missing event fields: {missing_fields}")
+        return build_response(f"Missing required information: {', '.join(missing_fields)}")
+
+    repo_name = event['repo_name']
+    branch_name = event['branch_name']
+    logs_url = event['logs_url']
+
     try:
-        repo_name = event['repo_name']
-        branch_name = event['branch_name']
-        logs_url = event['logs_url']
+        # The repository files and the workflow logs are independent, so fetch them concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            repo_files_future = executor.submit(fetch_files_from_github, repo_name, branch_name)
+            error_message_future = executor.submit(fetch_github_actions_details, logs_url)
 
-        repo_files_content = fetch_files_from_github(repo_name, branch_name)
+            repo_files = repo_files_future.result()
+            error_message = error_message_future.result()
 
-        error_message = fetch_github_actions_details(logs_url)
+        sent_files = select_repo_files(repo_files, error_message)
+        repo_files_content = build_repo_files_content(sent_files)
 
         if repo_files_content == '' or error_message == '':
             raise KeyError("Neither 'repo_files_content' nor 'error_message' were found.")
 
-        steps_to_remediate = get_steps_to_remediate(repo_files_content, error_message)
+        # A fix for the same failure whose branch is still open is reported rather than proposed again
+        cache_key = build_cache_key(repo_files_content, error_message)
+        cached_fix = get_cached_fix(cache_key)
+        if cached_fix and branch_exists(repo_name, cached_fix['branch_name']):
+            logger.info(f"Fix already proposed on branch: {cached_fix['branch_name']}")
+            final_response = build_response(f"Fix already proposed: {cached_fix['pr_url']}")
+            logger.info("Response: %s", json.dumps(final_response))
+            return final_response
+
+        # Look up the base commit for the fix branch while the model generates the remediation
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            base_commit_future = executor.submit(get_base_commit, repo_name)
 
-        fixed_code = remediate_code(repo_files_content, steps_to_remediate)
+            fixed_code_json = remediate_code(repo_files_content, error_message)
 
-        create_new_branch(fixed_code, repo_name)
+            base_commit = base_commit_future.result()
 
-        final_response = {'response': 'success'}
+        new_branch_name, pr_url = create_new_branch(fixed_code_json, repo_name, base_commit, sent_files.keys())
+
+        # Only recorded once the pull request exists, so a rejected fix is not reported on re-runs
+        put_cached_fix(cache_key, new_branch_name, pr_url)
+
+        final_response = build_response('success')
         logger.info("Response: %s", json.dumps(final_response))
         return final_response
 
     except KeyError as ke:
-        logger.error("Key error: {str(ke)}")
-        final_response = {'response': f"Missing required information: {str(ke)}"}
-        return final_response
+        logger.error(f"Key error: {str(ke)}")
+        return build_response(f"Missing required information: {str(ke)}")
 
     except Exception as e:
         logger.error("An error occurred: %s", e, exc_info=True)
-        final_response = {'response': f"Error: {str(e)}"}
-        return final_response
+        return build_response(f"Error: {str(e)}")
+
+def build_response(message):
+    return {'response': message}
 
 def fetch_files_from_github(repo_name, branch_name):
-    api_endpoint = f"https://api.github.com/repos/{repo_name}/contents?ref={branch_name}"
+    owner, name = repo_name.split('/', 1)
 
-    response = requests.get(api_endpoint, headers=GITHUB_HEADERS, timeout=60)
-    response.raise_for_status()
+    # One GraphQL round-trip returns the text of every root-level blob on the branch
+    data = run_github_graphql(
+        REPO_FILES_QUERY,
+        {"owner": owner, "name": name, "expression": f"{branch_name}:"}
+    )
 
-    files_content = ""
-    terraform_extensions = ['.tf', '.tfvars']
+    tree = data['repository']['object']
+    if tree is None:
+        raise Exception(f"Branch {branch_name} not found in {repo_name}.")
 
-    for item in response.json():
-        if item['type'] == 'file' and any(item['name'].endswith(ext) for ext in terraform_extensions):
-            file_response = requests.get(item['download_url'], headers=GITHUB_HEADERS, timeout=60)
-            file_response.raise_for_status()
-            files_content += f"File: {item['name']}\n"
-            files_content += file_response.text + "\n\n"
+    repo_files = {
+        entry['name']: entry['object']['text']
+        for entry in tree['entries']
+        if entry['type'] == 'blob' and entry['name'].endswith(TERRAFORM_EXTENSIONS)
+    }
 
     logger.info("Fetched repository files content successfully")
 
-    return files_content
+    return repo_files
+
+def run_github_graphql(query, variables):
+    # Serialized with orjson, the commit mutation carries every modified file base64-encoded
+    response = session.post(
+        "https://api.github.com/graphql",
+        data=orjson.dumps({"query": query, "variables": variables}),
+        headers={'Content-Type': 'application/json'},
+        timeout=60
+    )
+    response.raise_for_status()
+
+    # GraphQL reports failures in the body of a 200 response
+    response_json = orjson.loads(response.content)
+    if response_json.get('errors'):
+        raise Exception(f"GitHub GraphQL request failed: {response_json['errors']}")
+
+    return response_json['data']
+
+def select_repo_files(repo_files, error_message):
+    # Only send the files the error points at, falling back to all of them when it names none
+    referenced_files = {path.removeprefix('./') for path in TERRAFORM_FILE_PATTERN.findall(error_message)}
+    if referenced_files & repo_files.keys():
+        repo_files = {
+            name: text for name, text in repo_files.items()
+            if name in referenced_files or name in SHARED_TERRAFORM_FILES or name.endswith('.tfvars')
+        }
+
+    logger.info("Files sent to the model: %s", list(repo_files))
+
+    return repo_files
+
+def build_repo_files_content(repo_files):
+    return "".join(f"File: {name}\n{text}\n\n" for name, text in repo_files.items())
 
 def fetch_github_actions_details(logs_url):
 
     try:
         logger.info(f"Fetching logs from logs_url: {logs_url}")
-        logs_response = requests.get(logs_url, headers=GITHUB_HEADERS, timeout=60)
-        logs_response.raise_for_status()
+        # Stream the log so only the lines from the first error onwards are kept in memory
+        with session.get(logs_url, timeout=60, stream=True) as logs_response:
+            logs_response.raise_for_status()
 
-        log_content = logs_response.text
-        return extract_error_with_context(log_content)
+            # Large chunks keep the per-chunk Python overhead low on multi-MB logs
+            return extract_error_with_context(logs_response.iter_lines(chunk_size=64 * 1024))
 
     except requests.exceptions.HTTPError as http_err:
-        logger.error("HTTP error occurred while fetching GitHub Actions details: {http_err}")
+        logger.error(f"HTTP error occurred while fetching GitHub Actions details: {http_err}")
         raise
     except Exception as e:
-        logger.error("Error occurred while fetching GitHub Actions details: {e}")
+        logger.error(f"Error occurred while fetching GitHub Actions details: {e}")
         raise
 
-def extract_error_with_context(log_content):
-    lines = log_content.splitlines()
-    for idx, line in enumerate(lines):
-        if "error" in line.lower():
-            return "\n".join(lines[idx:]).strip()
+def extract_error_with_context(log_lines):
+    lines = iter(log_lines)
+    for line in lines:
+        if ERROR_PATTERN.search(line):
+            error_lines = [
+                LOG_NOISE_PATTERN.sub(b'', error_line)
+                for error_line in [line, *itertools.islice(lines, MAX_ERROR_CONTEXT_LINES - 1)]
+            ]
+            return b"\n".join(error_lines).decode('utf-8', errors='replace').strip()
     return ""
 
-def get_steps_to_remediate(repo_files_content, error_message):
+def remediate_code(repo_files_content, error_message):
 
     prompt = f"""
         <task>
-        You are an expert in troubleshooting Terraform code issues. Your role is to diagnose the root cause of an error and provide clear, step-by-step instructions for another AI to follow.
+        You are an expert in troubleshooting Terraform code issues and an automated code modification agent. Your task is to diagnose the root cause of an error, then apply your own resolution steps to the codebase and return a valid JSON object containing the full, modified files.
 
         <error_message>
         {error_message}
         </error_message>
 
-        <repo_files_content>
-        {repo_files_content}
-        </repo_files_content>
-        
-        <instructions>
-        1.  Provide a detailed "Root Cause Analysis" of the error.
-        2.  Provide numbered, "Step-by-Step Resolution" instructions.
-        3.  **Crucially, do NOT include any corrected code snippets or full code files in your response or how to test it.** Your only output should be the analysis and the instructional steps.
-        </instructions>
-        </task>
-        """
-
-    logger.info("Prompt to get the steps for remediation: %s", prompt)
-
-    steps_to_remediate = invoke_bedrock_model(prompt)
-    logger.info("Steps to Remediate: %s", steps_to_remediate)
-
-    return steps_to_remediate
-
-def remediate_code(repo_files_content, steps_to_remediate):
-
-    prompt = f"""
-        <task>
-        You are an expert automated code modification agent. Your task is to apply a set of instructions to a codebase and return a valid JSON object containing the full, modified files.
-
-        <steps_to_remediate>
-        {steps_to_remediate}
-        </steps_to_remediate>
-
-        <repo_files_content>
-        {repo_files_content}
-        </repo_files_content>
-        
         <instructions>
         1. Your only source of truth for the original code is the <repo_files_content> section.
-        2. Apply only the changes described in the <steps_to_remediate>. If a step includes a code snippet, **ignore the snippet** and use only the text instructions to perform the modification.
-        3. The `files` object in your JSON response **MUST contain the COMPLETE content of each modified file**. Do not return just diffs or partial content.
-        4. Return a single, valid JSON object enclosed in a `json` markdown code block, as shown in the format below.
-        5. Make sure the changes have proper indentation and formatting and don't fail the `terraform validate` command.
+        2. In the [TROUBLESHOOTING] section, provide a detailed "Root Cause Analysis" of the error followed by numbered, "Step-by-Step Resolution" instructions. **Do NOT include any corrected code snippets or full code files in this section or how to test it.**
+        3. In the [REMEDIATION_JSON] section, apply only the changes described in your [TROUBLESHOOTING] steps.
+        4. The `files` object in your JSON response **MUST contain the COMPLETE content of each modified file**. Do not return just diffs or partial content.
+        5. Return a single, valid JSON object enclosed in a `json` markdown code block, as shown in the format below.
+        6. Make sure the changes have proper indentation and formatting and don't fail the `terraform validate` command.
+        7. Return both sections in order, each starting with its marker on its own line.
         </instructions>
         <output_format>
+        [TROUBLESHOOTING]
+        Root Cause Analysis and Step-by-Step Resolution.
+
+        [REMEDIATION_JSON]
         ```json
         {{
           "commit_message": "Fix: A short, clear explanation of the fix based on the root cause analysis.",
@@ -164,103 +319,136 @@ def remediate_code(repo_files_content, steps_to_remediate):
 
     logger.info("Prompt for remediation: %s", prompt)
 
-    fixed_code = invoke_bedrock_model(prompt)
+    response = invoke_bedrock_model(repo_files_content, prompt)
 
-    logger.info("Fixed Code: %s", fixed_code)
+    # Fall back to the whole response, parse_fixed_code locates the JSON block in it
+    sections = RESPONSE_SECTIONS_PATTERN.search(response)
+    steps_to_remediate, fixed_code = sections.groups() if sections else ("", response)
 
-    return fixed_code
+    logger.info("Steps to Remediate: %s", steps_to_remediate.strip())
+    logger.info("Fixed Code: %s", fixed_code)
 
-def create_new_branch(fixed_code, repo_name):
-    files = {}
+    return parse_fixed_code(fixed_code)
 
-    fixed_code_json = json.loads(fixed_code.lstrip("```json").split("```")[0].strip().replace('`', ''))
+def parse_fixed_code(fixed_code):
+    json_fence = JSON_FENCE_PATTERN.search(fixed_code)
+    fixed_code_json = orjson.loads(json_fence.group(1) if json_fence else fixed_code.strip())
     logger.info("Fixed Code after stripping: %s", fixed_code_json)
 
+    missing_fields = [field for field in REMEDIATION_FIELDS if field not in fixed_code_json]
+    if missing_fields:
+        raise ValueError(f"Remediation is missing {missing_fields}")
+    if not isinstance(fixed_code_json['files'], dict):
+        raise ValueError("Remediation 'files' must map file paths to their content.")
+
+    return fixed_code_json
+
+def get_base_commit(repo_name):
+    base_commit = get_with_etag(f"https://api.github.com/repos/{repo_name}/git/refs/heads/main")["object"]["sha"]
+    logger.info(f"Main base_commit sha: {base_commit}")
+
+    return base_commit
+
+def get_with_etag(url):
+    etag_cache = load_etag_cache()
+    cached = etag_cache.get(url)
+
+    # GitHub answers an unchanged resource with a bodiless 304 that does not count against the rate limit
+    response = session.get(url, headers={'If-None-Match': cached['etag']} if cached else None, timeout=60)
+    if response.status_code == 304:
+        logger.info("Using cached response for: %s", url)
+        return orjson.loads(cached['body'])
+
+    response.raise_for_status()
+
+    if response.headers.get('ETag'):
+        etag_cache[url] = {'etag': response.headers['ETag'], 'body': response.text}
+        save_etag_cache(etag_cache)
+
+    return orjson.loads(response.content)
+
+def load_etag_cache():
+    try:
+        with open(ETAG_CACHE_PATH, 'rb') as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+
+def save_etag_cache(etag_cache):
+    try:
+        with open(ETAG_CACHE_PATH, 'wb') as f:
+            f.write(orjson.dumps(etag_cache))
+    except OSError as e:
+        logger.warning("Failed to write ETag cache: %s", e)
+
+def create_new_branch(fixed_code_json, repo_name, base_commit, sent_files):
+    files = {}
+
     new_branch_name = fixed_code_json['branch_name']
     commit_message = fixed_code_json['commit_message']
     pr_title = fixed_code_json['pr_title']
     pr_body = fixed_code_json['pr_body']
 
+    # The model only saw the sent files, full content for any other file would overwrite it blindly
     for filename, content in fixed_code_json.get("files").items():
+        filename = filename.removeprefix('./')
+        if filename not in sent_files:
+            logger.warning(f"Dropping {filename} from the fix, it was not sent to the model")
+            continue
         files[filename] = content.strip()
 
+    if not files:
+        raise ValueError("The remediation only changes files that were not sent to the model.")
+
     logger.info(f"New branch name: {new_branch_name}")
     logger.info(f"Commit Message: {commit_message}")
     logger.info(f"PR Title: {pr_title}")
     logger.info(f"PR body: {pr_body}")
     logger.info(f"Parsed repository path: {repo_name}")
 
-    # Get the base commit SHA
-    base_commit = requests.get(
-        f"https://api.github.com/repos/{repo_name}/git/refs/heads/main",
-        headers=GITHUB_HEADERS
-    ).json()["object"]["sha"]
-
-    logger.info(f"Main base_commit sha: {base_commit}")
-    # Check if the branch already exists
-    if requests.get(
-            f"https://api.github.com/repos/{repo_name}/git/refs/heads/{new_branch_name}",
-            headers=GITHUB_HEADERS
-    ).status_code == 200:
-        raise ValueError(f"Branch {new_branch_name} already exists.")
-
-    logger.info(f"Branch not exists so creating: {new_branch_name}")
-
-    # Create the new branch
-    response = requests.post(
+    # Create the new branch, GitHub rejects the ref if the branch already exists
+    response = session.post(
         f"https://api.github.com/repos/{repo_name}/git/refs",
-        json={"ref": f"refs/heads/{new_branch_name}", "sha": base_commit},
-        headers=GITHUB_HEADERS
+        json={"ref": f"refs/heads/{new_branch_name}", "sha": base_commit}
     )
 
     if response.status_code == 201:
         logger.info(f"Branch created: {new_branch_name}")
+    elif response.status_code == 422 and "already exists" in response.text:
+        raise ValueError(f"Branch {new_branch_name} already exists.")
     else:
-        logger.error("Failed to create branch {new_branch_name}. Response: {response.status_code}, {response.text}")
+        logger.error(f"Failed to create branch {new_branch_name}. Response: {response.status_code}, {response.text}")
         raise Exception(f"Failed to create branch {new_branch_name}.")
 
-    # Create blobs for each file
-    blobs = []
-    for file_name, file_content in files.items():
-        blob_payload = {
-            "content": base64.b64encode(file_content.encode()).decode(),
-            "encoding": "base64"
-        }
-        blob_sha = requests.post(
-            f"https://api.github.com/repos/{repo_name}/git/blobs",
-            json=blob_payload,
-            headers=GITHUB_HEADERS
-        ).json()["sha"]
-        blobs.append({"path": file_name, "mode": "100644", "type": "blob", "sha": blob_sha})
-
-    # Create a new tree
-    base_tree_sha = requests.get(
-        f"https://api.github.com/repos/{repo_name}/git/trees/{base_commit}",
-        headers=GITHUB_HEADERS
-    ).json()["sha"]
-    new_tree_sha = requests.post(
-        f"https://api.github.com/repos/{repo_name}/git/trees",
-        json={"base_tree": base_tree_sha, "tree": blobs},
-        headers=GITHUB_HEADERS
-    ).json()["sha"]
-
-    # Create a new commit
-    new_commit_sha = requests.post(
-        f"https://api.github.com/repos/{repo_name}/git/commits",
-        json={"message": commit_message, "tree": new_tree_sha, "parents": [base_commit]},
-        headers=GITHUB_HEADERS
-    ).json()["sha"]
-
-    # Update the branch reference to point to the new commit
-    requests.patch(
-        f"https://api.github.com/repos/{repo_name}/git/refs/heads/{new_branch_name}",
-        json={"sha": new_commit_sha},
-        headers=GITHUB_HEADERS
-    )
+    commit_files_to_branch(repo_name, new_branch_name, base_commit, files, commit_message)
+
+    pr_url = create_pull_request(repo_name, new_branch_name, "main", pr_title, pr_body)
+
+    return new_branch_name, pr_url
+
 
-    create_pull_request(repo_name, new_branch_name, "main", pr_title, pr_body)
+def commit_files_to_branch(repo_name, branch_name, base_commit, files, commit_message):
+    headline, _, body = commit_message.partition("\n")
+    message = {"headline": headline}
+    if body.strip():
+        message["body"] = body.strip()
 
-    return new_branch_name
+    # All files are committed atomically in one mutation instead of the blob/tree/commit/ref sequence
+    data = run_github_graphql(CREATE_COMMIT_MUTATION, {
+        "input": {
+            "branch": {"repositoryNameWithOwner": repo_name, "branchName": branch_name},
+            "message": message,
+            "fileChanges": {
+                "additions": [
+                    {"path": file_name, "contents": base64.b64encode(file_content.encode("utf-8")).decode("ascii")}
+                    for file_name, file_content in files.items()
+                ]
+            },
+            "expectedHeadOid": base_commit
+        }
+    })
+
+    logger.info(f"Committed {list(files)} to branch {branch_name}: {data['createCommitOnBranch']['commit']['url']}")
 
 
 def create_pull_request(repo_name, new_branch_name, base_branch, title, body):
@@ -272,43 +460,107 @@ def create_pull_request(repo_name, new_branch_name, base_branch, title, body):
         "base": base_branch
     }
 
-    response = requests.post(
+    response = session.post(
         f"https://api.github.com/repos/{repo_name}/pulls",
-        json=pr_payload,
-        headers=GITHUB_HEADERS
+        json=pr_payload
     )
 
     if response.status_code == 201:
         logger.info(f"Pull request created successfully: {response.json().get('html_url')}")
         return response.json().get('html_url')
     else:
-        logger.error("Failed to create pull request. Response: {response.status_code}, {response.text}")
+        logger.error(f"Failed to create pull request. Response: {response.status_code}, {response.text}")
         raise Exception("Failed to create pull request.")
 
-def invoke_bedrock_model(prompt):
+def invoke_bedrock_model(repo_files_content, prompt):
     try:
-        # Set Claude model ID directly
-        model_id = "amazon.titan-text-premier-v1:0"
-        body = json.dumps({
-            "inputText": prompt,
-            "textGenerationConfig": {
-                "temperature": 0.7,
-                "topP": 0.9,
-                "maxTokenCount": 3072,
-                "stopSequences": []
-            }
-        })
-
-        response = bedrock.invoke_model(
-            modelId=model_id,
-            body=body,
-            accept="application/json",
-            contentType="application/json"
+        # The repository files are sent ahead of a cache point, so a retry or re-run within the
+        # cache TTL only pays in full for the task-specific prompt after it
+        response = bedrock.converse_stream(
+            modelId=MODEL_ID,
+            system=[{"text": SYSTEM_PROMPT}],
+            messages=[{
+                "role": "user",
+                "content": [
+                    {"text": f"<repo_files_content>\n{repo_files_content}\n</repo_files_content>"},
+                    {"cachePoint": {"type": "default"}},
+                    {"text": prompt}
+                ]
+            }],
+            inferenceConfig=INFERENCE_CONFIG
         )
 
-        response_body = json.loads(response.get('body').read())
-        return response_body['results'][0]['outputText']
+        # Collect the generated text as it streams in
+        output_parts = []
+        stop_reason = None
+        for stream_event in response['stream']:
+            if 'contentBlockDelta' in stream_event:
+                output_parts.append(stream_event['contentBlockDelta']['delta'].get('text', ''))
+            elif 'messageStop' in stream_event:
+                stop_reason = stream_event['messageStop']['stopReason']
+            elif 'metadata' in stream_event:
+                usage = stream_event['metadata']['usage']
+                logger.info("Bedrock usage - input: %s, output: %s, cache read: %s, cache write: %s",
+                            usage['inputTokens'], usage['outputTokens'],
+                            usage.get('cacheReadInputTokens', 0), usage.get('cacheWriteInputTokens', 0))
+
+        # A truncated response cuts the fixed files short, so it is rejected before anything is parsed
+        if stop_reason == 'max_tokens':
+            raise ValueError(f"Bedrock response was truncated at {INFERENCE_CONFIG['maxTokens']} output tokens")
+
+        return "".join(output_parts)
+
+    except Exception as e:
+        logger.error(f"Error invoking Bedrock model: {e}")
+        raise
+
+def build_cache_key(repo_files_content, error_message):
+    # The error text is stripped of timestamps and colours, so re-runs of the same failure share a key
+    return hashlib.sha256(
+        "\0".join([MODEL_ID, SYSTEM_PROMPT, repo_files_content, error_message]).encode()
+    ).hexdigest()
+
+def branch_exists(repo_name, branch_name):
+    response = session.get(f"https://api.github.com/repos/{repo_name}/branches/{branch_name}")
+    if response.status_code == 404:
+        return False
+
+    response.raise_for_status()
+    return True
+
+def get_cached_fix(cache_key):
+    if not BEDROCK_CACHE_TABLE:
+        return None
+
+    try:
+        item = dynamodb.get_item(
+            TableName=BEDROCK_CACHE_TABLE,
+            Key={"cache_key": {"S": cache_key}}
+        ).get("Item")
+    except Exception as e:
+        logger.warning("Failed to read the fix cache: %s", e)
+        return None
+
+    # DynamoDB removes expired items lazily, so they can still be returned for a while. Items written
+    # before fixes were recorded hold a raw model response and are skipped
+    if item is None or "pr_url" not in item or int(item["expires_at"]["N"]) < time.time():
+        return None
+
+    return {"branch_name": item["branch_name"]["S"], "pr_url": item["pr_url"]["S"]}
+
+def put_cached_fix(cache_key, branch_name, pr_url):
+    if not BEDROCK_CACHE_TABLE:
+        return
 
+    try:
+        dynamodb.put_item(
+            TableName=BEDROCK_CACHE_TABLE,
+            Item={
+                "cache_key": {"S": cache_key},
+                "branch_name": {"S": branch_name},
+                "pr_url": {"S": pr_url},
+                "expires_at": {"N": str(int(time.time()) + BEDROCK_CACHE_TTL_SECONDS)}
+            }
+        )
     except Exception as e:
-        logger.error("Error invoking Bedrock model: {e}")
-        raise
\ No newline at end of file
+        logger.warning("Failed to write the fix cache: %s", e)